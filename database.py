@@ -4,8 +4,9 @@ Handles all SQLite database operations for user data and queue state persistence
 """
 
 import sqlite3
-import json
-from datetime import datetime
+import queue
+import threading
+from contextlib import contextmanager
 from typing import Optional, List, Dict, Any
 from dataclasses import dataclass, asdict
 from enum import Enum
@@ -34,362 +35,491 @@ class User:
         return asdict(self)
 
 
+# Hot-path SQL kept as module-level constants so the per-connection
+# prepared-statement cache always sees the exact same statement text
+_SQL_GET_USER = "SELECT * FROM users WHERE user_id = ?"
+_SQL_USER_EXISTS = "SELECT 1 FROM users WHERE user_id = ?"
+_SQL_LINK_EXISTS = "SELECT 1 FROM users WHERE referral_link = ?"
+_SQL_UPDATE_STATUS = """
+    UPDATE users
+    SET status = ?, assigned_to = ?, updated_at = CURRENT_TIMESTAMP
+    WHERE user_id = ?
+"""
+_SQL_INCREMENT_COMPLETED = """
+    UPDATE users
+    SET completed_referrals = completed_referrals + 1, updated_at = CURRENT_TIMESTAMP
+    WHERE user_id = ?
+"""
+_SQL_HAS_INTERACTED = """
+    SELECT 1 FROM referral_history
+    WHERE referrer_id = ? AND referee_id = ?
+    LIMIT 1
+"""
+_SQL_QUEUE_ADD = """
+    INSERT INTO queue (user_id, referral_link, timestamp)
+    VALUES (?, ?, strftime('%Y-%m-%d %H:%M:%f', 'now'))
+    ON CONFLICT(user_id) DO UPDATE SET referral_link = excluded.referral_link
+"""
+_SQL_QUEUE_POP_FIRST = """
+    DELETE FROM queue
+    WHERE user_id = (SELECT user_id FROM queue ORDER BY timestamp ASC LIMIT 1)
+    RETURNING user_id, referral_link
+"""
+_SQL_QUEUE_GET_ALL = """
+    SELECT user_id, referral_link
+    FROM queue
+    ORDER BY timestamp ASC
+"""
+_SQL_QUEUE_LIST_WITH_USERS = """
+    SELECT q.user_id, u.status, u.completed_referrals
+    FROM queue q
+    JOIN users u ON u.user_id = q.user_id
+    ORDER BY q.timestamp ASC
+    LIMIT ?
+"""
+_SQL_QUEUE_DELETE = "DELETE FROM queue WHERE user_id = ?"
+_SQL_QUEUE_REQUEUE = """
+    UPDATE queue
+    SET timestamp = strftime('%Y-%m-%d %H:%M:%f', 'now')
+    WHERE user_id = ?
+"""
+_SQL_QUEUE_FIRST_WAITING = """
+    SELECT q.user_id
+    FROM queue q
+    JOIN users u ON u.user_id = q.user_id
+    WHERE u.status = ?
+    ORDER BY q.timestamp ASC, q.user_id ASC
+    LIMIT 1
+"""
+_SQL_COUNT_QUEUE_STATUSES = """
+    SELECT u.status, COUNT(*) AS n
+    FROM queue q
+    JOIN users u ON u.user_id = q.user_id
+    GROUP BY u.status
+"""
+_SQL_QUEUE_NEXT_AFTER = """
+    WITH me AS (SELECT timestamp, user_id FROM queue WHERE user_id = ?)
+    SELECT q.user_id
+    FROM queue q, me
+    WHERE (q.timestamp, q.user_id) > (me.timestamp, me.user_id)
+    ORDER BY q.timestamp, q.user_id
+    LIMIT ?
+"""
+_SQL_QUEUE_NEXT_ELIGIBLE = """
+    WITH me AS (SELECT timestamp, user_id FROM queue WHERE user_id = ?)
+    SELECT q.user_id
+    FROM queue q, me
+    WHERE (q.timestamp, q.user_id) > (me.timestamp, me.user_id)
+      AND NOT EXISTS (
+          SELECT 1 FROM referral_history h
+          WHERE h.referrer_id = me.user_id AND h.referee_id = q.user_id
+      )
+    ORDER BY q.timestamp, q.user_id
+    LIMIT 1
+"""
+
+
+def _user_from_row(row: sqlite3.Row) -> User:
+    """Build a User from a users-table row"""
+    return User(
+        user_id=row["user_id"],
+        referral_link=row["referral_link"],
+        status=row["status"],
+        assigned_to=row["assigned_to"],
+        created_at=row["created_at"],
+        updated_at=row["updated_at"],
+        completed_referrals=row["completed_referrals"],
+    )
+
+
 class Database:
     """
     SQLite database manager for the referral bot
     Handles user storage, queue persistence, and state management
     """
 
-    def __init__(self, db_path: str = "referral_bot.db"):
-        """Initialize database connection and create tables if needed"""
+    POOL_SIZE = 5
+
+    def __init__(self, db_path: str = "referral_bot.db", pool_size: int = POOL_SIZE):
+        """Initialize writer + reader connections and create tables if needed"""
         self.db_path = db_path
+        # WAL allows many concurrent readers alongside exactly one writer:
+        # keep one dedicated write connection behind a lock, plus a pool of
+        # read-only connections so reads never queue behind writes
+        self._writer = self._new_connection()
+        self._writer_lock = threading.Lock()
         self.init_db()
-
-    def _get_connection(self):
-        """Get database connection"""
-        conn = sqlite3.connect(self.db_path)
+        self._pool: "queue.Queue[sqlite3.Connection]" = queue.Queue(maxsize=pool_size)
+        for _ in range(pool_size):
+            self._pool.put(self._new_connection(readonly=True))
+
+    def _new_connection(self, readonly: bool = False) -> sqlite3.Connection:
+        """Open a new long-lived connection with tuned PRAGMAs"""
+        if readonly:
+            conn = sqlite3.connect(
+                f"file:{self.db_path}?mode=ro", uri=True,
+                check_same_thread=False, isolation_level=None,
+            )
+        else:
+            # isolation_level=None puts the connection in autocommit mode;
+            # writes manage their own BEGIN IMMEDIATE / COMMIT via transaction()
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+            # WAL lets readers proceed while a writer commits, and NORMAL
+            # sync avoids an fsync per commit; both persist in the DB file
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
         conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA cache_size=-20000")
+        conn.execute("PRAGMA busy_timeout=5000")
         return conn
 
+    @contextmanager
+    def _conn(self):
+        """Borrow a read-only connection from the pool for a block"""
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run a block of statements on the writer as one BEGIN IMMEDIATE
+        transaction; the write lock is taken up front, commit fsyncs once
+        """
+        with self._writer_lock:
+            self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._writer
+            except Exception:
+                self._writer.execute("ROLLBACK")
+                raise
+            self._writer.execute("COMMIT")
+
+    def close(self):
+        """Close the writer and all pooled reader connections"""
+        self._writer.close()
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
     def init_db(self):
         """Initialize database tables"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-
-        # Create users table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                referral_link TEXT NOT NULL UNIQUE,
-                status TEXT NOT NULL DEFAULT 'waiting',
-                assigned_to INTEGER,
-                completed_referrals INTEGER DEFAULT 0,
-                created_at TEXT NOT NULL,
-                updated_at TEXT NOT NULL
-            )
-        """)
-
-        # Create referral history table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS referral_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                referrer_id INTEGER NOT NULL,
-                referee_id INTEGER NOT NULL,
-                completed_at TEXT NOT NULL,
-                FOREIGN KEY (referrer_id) REFERENCES users(user_id),
-                FOREIGN KEY (referee_id) REFERENCES users(user_id)
-            )
-        """)
+        with self._writer_lock:
+            cursor = self._writer.cursor()
 
-        # Create queue state table (for persistence across restarts)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS queue_state (
-                queue_order TEXT NOT NULL,
-                last_updated TEXT NOT NULL
-            )
-        """)
-
-        # Create persistent queue table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS queue (
-                user_id INTEGER PRIMARY KEY,
-                referral_link TEXT NOT NULL,
-                timestamp TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        conn.commit()
-        conn.close()
+            # Create users table
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY,
+                    referral_link TEXT NOT NULL UNIQUE,
+                    status TEXT NOT NULL DEFAULT 'waiting',
+                    assigned_to INTEGER,
+                    completed_referrals INTEGER DEFAULT 0,
+                    created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+
+            # Create referral history table
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS referral_history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    referrer_id INTEGER NOT NULL,
+                    referee_id INTEGER NOT NULL,
+                    completed_at TEXT NOT NULL,
+                    FOREIGN KEY (referrer_id) REFERENCES users(user_id),
+                    FOREIGN KEY (referee_id) REFERENCES users(user_id)
+                )
+            """)
+
+            # Create persistent queue table. Timestamps order the queue by
+            # string comparison, so every write path must share the same
+            # millisecond precision as the requeue UPDATE — a second-precision
+            # insert would sort ahead of an earlier same-second requeue
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS queue (
+                    user_id INTEGER PRIMARY KEY,
+                    referral_link TEXT NOT NULL,
+                    timestamp TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now'))
+                )
+            """)
+
+            # Indexes for the hot lookup/sort columns; referral_link already
+            # carries an implicit unique index from its column constraint
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_status ON users(status)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_refhist_pair ON referral_history(referrer_id, referee_id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_queue_ts ON queue(timestamp)")
 
     def add_user(self, user_id: int, referral_link: str) -> bool:
         """
         Add a new user to the database
         Returns True if successful, False if user already exists
         """
-        conn = self._get_connection()
-        cursor = conn.cursor()
+        with self.transaction() as conn:
+            # ON CONFLICT DO NOTHING: duplicates report rowcount 0 instead
+            # of raising/unwinding an IntegrityError on the common path
+            cursor = conn.execute("""
+                INSERT INTO users (user_id, referral_link, status, created_at, updated_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+                ON CONFLICT DO NOTHING
+            """, (user_id, referral_link, UserStatus.WAITING.value))
+            return cursor.rowcount == 1
 
-        try:
-            now = datetime.now().isoformat()
-            cursor.execute("""
+    def register_user(self, user_id: int, referral_link: str) -> str:
+        """
+        Atomically add a user and enqueue them in one transaction
+        Returns "ok", "user_exists" or "link_exists"
+        """
+        with self.transaction() as conn:
+            if conn.execute(_SQL_USER_EXISTS, (user_id,)).fetchone():
+                return "user_exists"
+            if conn.execute(_SQL_LINK_EXISTS, (referral_link,)).fetchone():
+                return "link_exists"
+            conn.execute("""
                 INSERT INTO users (user_id, referral_link, status, created_at, updated_at)
-                VALUES (?, ?, ?, ?, ?)
-            """, (user_id, referral_link, UserStatus.WAITING.value, now, now))
-            conn.commit()
-            return True
-        except sqlite3.IntegrityError:
-            # User or link already exists
-            return False
-        finally:
-            conn.close()
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+            """, (user_id, referral_link, UserStatus.WAITING.value))
+            conn.execute(_SQL_QUEUE_ADD, (user_id, referral_link))
+        return "ok"
 
     def get_user(self, user_id: int) -> Optional[User]:
         """Retrieve a user by user_id"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
+        with self._conn() as conn:
+            cursor = conn.cursor()
 
-        cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        row = cursor.fetchone()
-        conn.close()
+            cursor.execute(_SQL_GET_USER, (user_id,))
+            row = cursor.fetchone()
 
         if row:
-            return User(
-                user_id=row["user_id"],
-                referral_link=row["referral_link"],
-                status=row["status"],
-                assigned_to=row["assigned_to"],
-                created_at=row["created_at"],
-                updated_at=row["updated_at"],
-                completed_referrals=row["completed_referrals"],
-            )
+            return _user_from_row(row)
         return None
 
     def user_exists(self, user_id: int) -> bool:
         """Check if a user exists"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
-        exists = cursor.fetchone() is not None
-        conn.close()
-        return exists
+        with self._conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(_SQL_USER_EXISTS, (user_id,))
+            return cursor.fetchone() is not None
 
     def link_exists(self, referral_link: str) -> bool:
         """Check if a referral link is already in the system"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1 FROM users WHERE referral_link = ?", (referral_link,))
-        exists = cursor.fetchone() is not None
-        conn.close()
-        return exists
+        with self._conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(_SQL_LINK_EXISTS, (referral_link,))
+            return cursor.fetchone() is not None
 
     def update_user_status(self, user_id: int, status: str, assigned_to: Optional[int] = None) -> bool:
         """Update user status"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-
-        now = datetime.now().isoformat()
-        cursor.execute("""
-            UPDATE users
-            SET status = ?, assigned_to = ?, updated_at = ?
-            WHERE user_id = ?
-        """, (status, assigned_to, now, user_id))
-
-        success = cursor.rowcount > 0
-        conn.commit()
-        conn.close()
-        return success
+        with self.transaction() as conn:
+            cursor = conn.execute(_SQL_UPDATE_STATUS, (status, assigned_to, user_id))
+            return cursor.rowcount > 0
 
     def increment_completed_referrals(self, user_id: int) -> bool:
         """Increment completed referrals count for a user"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-
-        now = datetime.now().isoformat()
-        cursor.execute("""
-            UPDATE users
-            SET completed_referrals = completed_referrals + 1, updated_at = ?
-            WHERE user_id = ?
-        """, (now, user_id))
-
-        success = cursor.rowcount > 0
-        conn.commit()
-        conn.close()
-        return success
+        with self.transaction() as conn:
+            cursor = conn.execute(_SQL_INCREMENT_COMPLETED, (user_id,))
+            return cursor.rowcount > 0
 
     def remove_user(self, user_id: int) -> bool:
-        """Remove a user from the system"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
-        success = cursor.rowcount > 0
-        conn.commit()
-        conn.close()
-        return success
+        """Remove a user from the system, including their pairing history"""
+        with self.transaction() as conn:
+            # History rows reference users, so purge them first now that
+            # foreign keys are enforced
+            conn.execute(
+                "DELETE FROM referral_history WHERE referrer_id = ? OR referee_id = ?",
+                (user_id, user_id),
+            )
+            # Anyone still assigned to this user would keep a dangling
+            # reference that breaks their /done later on
+            conn.execute(
+                "UPDATE users SET assigned_to = NULL, updated_at = CURRENT_TIMESTAMP WHERE assigned_to = ?",
+                (user_id,),
+            )
+            cursor = conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+            return cursor.rowcount > 0
 
     def get_all_users(self) -> List[User]:
         """Get all users"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT * FROM users ORDER BY created_at ASC")
-        rows = cursor.fetchall()
-        conn.close()
-
-        return [
-            User(
-                user_id=row["user_id"],
-                referral_link=row["referral_link"],
-                status=row["status"],
-                assigned_to=row["assigned_to"],
-                created_at=row["created_at"],
-                updated_at=row["updated_at"],
-                completed_referrals=row["completed_referrals"],
-            )
-            for row in rows
-        ]
+        with self._conn() as conn:
+            cursor = conn.cursor()
 
-    def get_users_by_status(self, status: str) -> List[User]:
-        """Get all users with a specific status"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT * FROM users WHERE status = ? ORDER BY created_at ASC", (status,))
-        rows = cursor.fetchall()
-        conn.close()
-
-        return [
-            User(
-                user_id=row["user_id"],
-                referral_link=row["referral_link"],
-                status=row["status"],
-                assigned_to=row["assigned_to"],
-                created_at=row["created_at"],
-                updated_at=row["updated_at"],
-                completed_referrals=row["completed_referrals"],
-            )
-            for row in rows
-        ]
+            cursor.execute("SELECT * FROM users ORDER BY created_at ASC")
+            rows = cursor.fetchall()
 
-    def add_referral_history(self, referrer_id: int, referee_id: int) -> bool:
-        """Record a completed referral"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
+        return [_user_from_row(row) for row in rows]
 
-        try:
-            now = datetime.now().isoformat()
-            cursor.execute("""
-                INSERT INTO referral_history (referrer_id, referee_id, completed_at)
-                VALUES (?, ?, ?)
-            """, (referrer_id, referee_id, now))
-            conn.commit()
-            return True
-        finally:
-            conn.close()
-
-    def get_queue_state(self) -> Optional[List[int]]:
-        """Retrieve saved queue state"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
+    def iter_all_users(self, batch_size: int = 1000):
+        """
+        Yield users in creation order without materializing the whole table
+        Fetches batch_size rows at a time
+        """
+        with self._conn() as conn:
+            cursor = conn.execute("SELECT * FROM users ORDER BY created_at ASC")
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield _user_from_row(row)
 
-        cursor.execute("SELECT queue_order FROM queue_state LIMIT 1")
-        row = cursor.fetchone()
-        conn.close()
+    def get_users_by_status(self, status: str) -> List[User]:
+        """Get all users with a specific status"""
+        with self._conn() as conn:
+            cursor = conn.cursor()
 
-        if row:
-            try:
-                return json.loads(row["queue_order"])
-            except (json.JSONDecodeError, TypeError):
-                return None
-        return None
+            cursor.execute("SELECT * FROM users WHERE status = ? ORDER BY created_at ASC", (status,))
+            rows = cursor.fetchall()
 
-    def save_queue_state(self, queue_order: List[int]) -> bool:
-        """Save queue state for persistence"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
+        return [_user_from_row(row) for row in rows]
 
-        try:
-            now = datetime.now().isoformat()
-            # Clear old state and insert new one
-            cursor.execute("DELETE FROM queue_state")
-            cursor.execute("""
-                INSERT INTO queue_state (queue_order, last_updated)
-                VALUES (?, ?)
-            """, (json.dumps(queue_order), now))
-            conn.commit()
+    def add_referral_history(self, referrer_id: int, referee_id: int) -> bool:
+        """Record a completed referral"""
+        with self.transaction() as conn:
+            conn.execute("""
+                INSERT INTO referral_history (referrer_id, referee_id, completed_at)
+                VALUES (?, ?, CURRENT_TIMESTAMP)
+            """, (referrer_id, referee_id))
             return True
-        finally:
-            conn.close()
 
     def get_stats(self) -> Dict[str, Any]:
         """Get bot statistics"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT COUNT(*) as count FROM users")
-        total_users = cursor.fetchone()["count"]
-
-        cursor.execute("SELECT COUNT(*) as count FROM users WHERE status = ?", (UserStatus.WAITING.value,))
-        waiting_users = cursor.fetchone()["count"]
+        with self._conn() as conn:
+            cursor = conn.cursor()
 
-        cursor.execute("SELECT COUNT(*) as count FROM users WHERE status = ?", (UserStatus.ASSIGNED.value,))
-        assigned_users = cursor.fetchone()["count"]
-
-        cursor.execute("SELECT COUNT(*) as count FROM referral_history")
-        completed_referrals = cursor.fetchone()["count"]
+            # One pass over users instead of three separate COUNT scans
+            cursor.execute("""
+                SELECT COUNT(*) AS total,
+                       SUM(CASE WHEN status = ? THEN 1 ELSE 0 END) AS waiting,
+                       SUM(CASE WHEN status = ? THEN 1 ELSE 0 END) AS assigned
+                FROM users
+            """, (UserStatus.WAITING.value, UserStatus.ASSIGNED.value))
+            row = cursor.fetchone()
 
-        conn.close()
+            cursor.execute("SELECT COUNT(*) as count FROM referral_history")
+            completed_referrals = cursor.fetchone()["count"]
 
         return {
-            "total_users": total_users,
-            "waiting_users": waiting_users,
-            "assigned_users": assigned_users,
+            "total_users": row["total"],
+            "waiting_users": row["waiting"] or 0,
+            "assigned_users": row["assigned"] or 0,
             "completed_referrals": completed_referrals,
         }
 
     def clear_all(self):
         """Clear all data (useful for testing/reset)"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM referral_history")
+            conn.execute("DELETE FROM queue")
+            conn.execute("DELETE FROM users")
 
-        cursor.execute("DELETE FROM referral_history")
-        cursor.execute("DELETE FROM queue_state")
-        cursor.execute("DELETE FROM users")
-
-        conn.commit()
-        conn.close()
     def has_interacted_before(self, user_id: int, target_id: int) -> bool:
         """
         Check if user_id has previously interacted with target_id
         Returns True if they have already been paired, False otherwise
         """
-        conn = self._get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute("""
-            SELECT 1 FROM referral_history 
-            WHERE referrer_id = ? AND referee_id = ?
-        """, (user_id, target_id))
-        result = cursor.fetchone()
-        conn.close()
+        with self._conn() as conn:
+            cursor = conn.cursor()
 
-        return result is not None
+            cursor.execute(_SQL_HAS_INTERACTED, (user_id, target_id))
+            return cursor.fetchone() is not None
 
     def queue_add(self, user_id: int, link: str):
-        with self._get_connection() as conn:
-            conn.execute("""
-                INSERT OR REPLACE INTO queue (user_id, referral_link)
-                VALUES (?, ?)
-            """, (user_id, link))
-
+        # Upsert instead of INSERT OR REPLACE: a re-submitted link keeps the
+        # original timestamp, so the user keeps their place in the queue
+        with self.transaction() as conn:
+            conn.execute(_SQL_QUEUE_ADD, (user_id, link))
 
     def queue_pop_first(self):
-        with self._get_connection() as conn:
-            row = conn.execute("""
-                SELECT user_id, referral_link FROM queue
-                ORDER BY timestamp ASC
-                LIMIT 1
-            """).fetchone()
+        # Single atomic pop via DELETE ... RETURNING (SQLite >= 3.35)
+        with self.transaction() as conn:
+            row = conn.execute(_SQL_QUEUE_POP_FIRST).fetchone()
 
-            if not row:
-                return None, None
+        if not row:
+            return None, None
+        return row["user_id"], row["referral_link"]
 
-            user_id, link = row
+    def queue_get_all(self):
+        with self._conn() as conn:
+            rows = conn.execute(_SQL_QUEUE_GET_ALL).fetchall()
+            return rows
+
+    def queue_list_with_users(self, limit: Optional[int] = None):
+        """
+        Fetch the queue page joined with each user's status and referral
+        count — one round-trip for everything the listing needs
+        """
+        with self._conn() as conn:
+            rows = conn.execute(
+                _SQL_QUEUE_LIST_WITH_USERS,
+                (limit if limit is not None else -1,),
+            ).fetchall()
+            return rows
 
-            conn.execute("DELETE FROM queue WHERE user_id = ?", (user_id,))
-            return user_id, link
+    def queue_next_after(self, user_id: int, k: int = 1) -> List[int]:
+        """
+        Return up to k user_ids queued directly behind user_id, via a
+        range scan on the timestamp index instead of walking the queue
+        """
+        with self._conn() as conn:
+            rows = conn.execute(_SQL_QUEUE_NEXT_AFTER, (user_id, k)).fetchall()
+        return [row["user_id"] for row in rows]
 
+    def queue_next_eligible(self, user_id: int) -> Optional[int]:
+        """
+        Find the first user queued behind user_id that they have not been
+        paired with before, in one indexed query (no per-candidate probes)
+        """
+        with self._conn() as conn:
+            row = conn.execute(_SQL_QUEUE_NEXT_ELIGIBLE, (user_id,)).fetchone()
+            return row["user_id"] if row else None
 
-    def queue_get_all(self):
-        with self._get_connection() as conn:
-            rows = conn.execute("""
-                SELECT user_id, referral_link
-                FROM queue
-                ORDER BY timestamp ASC
-            """).fetchall()
-            return rows
-            
     def queue_delete(self, user_id: int):
-        with self._get_connection() as conn:
-            conn.execute("DELETE FROM queue WHERE user_id = ?", (user_id,))
-            conn.commit()
+        with self.transaction() as conn:
+            conn.execute(_SQL_QUEUE_DELETE, (user_id,))
+
+    def complete_referral(self, user_id: int, target_id: Optional[int], referral_link: str):
+        """
+        Record a completed referral as one transaction: bump the counter,
+        write history, reset status and requeue — a single commit/fsync
+        instead of four. The requeue rewrites the timestamp at millisecond
+        precision so back-of-queue order holds within the same second.
+        """
+        with self.transaction() as conn:
+            conn.execute(_SQL_INCREMENT_COMPLETED, (user_id,))
+            # The referee may have left since the assignment; skip the
+            # history row rather than trip the foreign key on them
+            if target_id and conn.execute(_SQL_USER_EXISTS, (target_id,)).fetchone():
+                conn.execute("""
+                    INSERT INTO referral_history (referrer_id, referee_id, completed_at)
+                    VALUES (?, ?, CURRENT_TIMESTAMP)
+                """, (user_id, target_id))
+            conn.execute(_SQL_UPDATE_STATUS, (UserStatus.WAITING.value, None, user_id))
+            cursor = conn.execute(_SQL_QUEUE_REQUEUE, (user_id,))
+            if cursor.rowcount == 0:
+                conn.execute(_SQL_QUEUE_ADD, (user_id, referral_link))
+
+    def queue_first_waiting(self) -> Optional[int]:
+        """
+        Return the first queued user whose status is still WAITING, using
+        one JOIN over the indexed status/timestamp columns
+        """
+        with self._conn() as conn:
+            row = conn.execute(_SQL_QUEUE_FIRST_WAITING, (UserStatus.WAITING.value,)).fetchone()
+            return row["user_id"] if row else None
+
+    def count_queue_statuses(self) -> Dict[str, int]:
+        """
+        Count queued users per status in a single GROUP BY query instead
+        of a get_user round-trip per queue entry
+        """
+        with self._conn() as conn:
+            rows = conn.execute(_SQL_COUNT_QUEUE_STATUSES).fetchall()
+        return {row["status"]: row["n"] for row in rows}
@@ -1,11 +1,27 @@
 import os
-import threading
-import atexit
 import asyncio
+import json
+import logging
 import re
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from flask import Flask, request
-from telegram import Update, ReplyKeyboardMarkup
+import time
+from itertools import islice
+
+try:
+    # uvloop's C event loop is ~2x faster than the default selector loop
+    # for network-bound workloads; must be installed before loops are made
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+try:
+    # orjson parses webhook payloads a few times faster than stdlib json
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+from quart import Quart, request
+from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -15,70 +31,124 @@ from telegram.ext import (
     CallbackContext,
     CallbackQueryHandler
 )
+from telegram.request import HTTPXRequest
 from database import Database, UserStatus
 from queue_manager import QueueManager
 
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-
-# --- Functie: Foutmelding - gebruiker is nog niet in de groep ---
-def get_not_member_buttons():
-    keyboard = [
-        [InlineKeyboardButton("Join Channel ➡️", url="https://t.me/ref4refupdates")],
-        [InlineKeyboardButton("Refresh 🔄", callback_data="refresh_membership")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
-
-# --- Functie: Welkomstbericht /start ---
-def get_welcome_buttons():
-    keyboard = [
-        [InlineKeyboardButton("Send Referral Link 📤", callback_data="send_link")],
-        [InlineKeyboardButton("Help ❓", callback_data="help")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
-
-# --- Functie: Queue toegevoegd / referral link geaccepteerd ---
-def get_queue_buttons():
-    keyboard = [
-        [InlineKeyboardButton("Cancel ❌", callback_data="cancel_queue")],
-        [InlineKeyboardButton("Switch 🔄", callback_data="switch_link")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
-
-# --- Functie: Help pagina knoppen ---
-def get_help_buttons():
-    keyboard = [
-        [InlineKeyboardButton("Send Referral Link 📤", callback_data="send_link")],
-        [InlineKeyboardButton("My Info ℹ️", callback_data="my_info")],
-        [InlineKeyboardButton("Back 🔙", callback_data="back")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+log = logging.getLogger(__name__)
+
+# Inline keyboards are immutable in PTB; build them once at import time
+# instead of per reply
+
+# --- Foutmelding - gebruiker is nog niet in de groep ---
+NOT_MEMBER_BUTTONS = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Join Channel ➡️", url="https://t.me/ref4refupdates")],
+    [InlineKeyboardButton("Refresh 🔄", callback_data="refresh_membership")]
+])
+
+# --- Welkomstbericht /start ---
+WELCOME_BUTTONS = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Send Referral Link 📤", callback_data="send_link")],
+    [InlineKeyboardButton("Help ❓", callback_data="help")]
+])
+
+# --- Queue toegevoegd / referral link geaccepteerd ---
+QUEUE_BUTTONS = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Cancel ❌", callback_data="cancel_queue")],
+    [InlineKeyboardButton("Switch 🔄", callback_data="switch_link")]
+])
+
+# --- Help pagina knoppen ---
+HELP_BUTTONS = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Send Referral Link 📤", callback_data="send_link")],
+    [InlineKeyboardButton("My Info ℹ️", callback_data="my_info")],
+    [InlineKeyboardButton("Back 🔙", callback_data="back")]
+])
 
 
 CHANNEL_USERNAME = "@ref4refupdates"  # channel users must join
 
+HELP_TEXT = (
+    "Use the buttons to quickly access actions:\n"
+    "📤 Send Referral Link: submit your link and join the queue\n"
+    "ℹ️ My Info: view your status and credits\n"
+    "✅ Done Referral: confirm a completed referral\n"
+    "📋 Queue Status: check the current queue\n"
+    "❓ Help: short explanation"
+)
+
+WELCOME_MESSAGE = (
+    "🎉 Welcome to Referral4Referral Bot!\n\n"
+    "Here's how it works:\n"
+    "1️⃣ Send your referral link\n"
+    "2️⃣ You'll be placed in a queue\n"
+    "3️⃣ When it's your turn, you'll receive another user's referral link\n"
+    "4️⃣ Complete the referral and click '✅ Done'\n"
+    "5️⃣ You'll earn credit and rejoin the queue\n\n"
+    "📤 Send your referral link now to get started!"
+)
+
+# get_chat_member is a full Telegram round-trip; remember the answer per
+# user for a minute so repeat messages in one session skip the call
+_MEMBERSHIP_TTL = 60  # seconds
+_MEMBERSHIP_CACHE_MAX = 10_000  # entries
+_membership_cache: dict[int, tuple[float, bool]] = {}
+
 async def check_membership(update: Update, context: CallbackContext) -> bool:
     user_id = update.effective_user.id
+    cached = _membership_cache.get(user_id)
+    if cached and time.monotonic() - cached[0] < _MEMBERSHIP_TTL:
+        return cached[1]
     try:
         member = await context.bot.get_chat_member(CHANNEL_USERNAME, user_id)
-        if member.status in ["member", "administrator", "creator"]:
-            return True
-        else:
-            return False
-    except:
+    except TelegramError:
+        # Treat the failure as non-membership for this message only: a
+        # cached False would keep ejecting a real member for the full TTL
         return False
+    is_member = member.status in ["member", "administrator", "creator"]
+    if len(_membership_cache) >= _MEMBERSHIP_CACHE_MAX:
+        # Drop expired entries; if everything is still fresh, evict the
+        # oldest insertion so the cache stays bounded
+        now = time.monotonic()
+        for uid in [uid for uid, (ts, _) in _membership_cache.items() if now - ts >= _MEMBERSHIP_TTL]:
+            del _membership_cache[uid]
+        if len(_membership_cache) >= _MEMBERSHIP_CACHE_MAX:
+            del _membership_cache[next(iter(_membership_cache))]
+    _membership_cache[user_id] = (time.monotonic(), is_member)
+    return is_member
 # --- End force join check ---
 
 
 TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))  # Set in environment
-app = Flask(__name__)
+# Public base URL of this deployment (e.g. https://myapp.onrender.com);
+# when set, the webhook is registered at startup
+WEBHOOK_BASE = os.getenv("WEBHOOK_URL", "").rstrip("/")
+app = Quart(__name__)
 
 # Initialize database and queue manager
 db = Database("referral_bot.db")
 queue_manager = QueueManager(db)
 
-# Create the Telegram Application
-application = Application.builder().token(TOKEN).build()
+# Serialize queue mutations: SQLite writes serialize at the DB layer
+# anyway, and taking the lock up here keeps multi-step operations
+# (e.g. complete + reassign) from interleaving between handlers
+_write_lock = asyncio.Lock()
+
+# Create the Telegram Application; a larger connection pool so broadcasts
+# don't queue up behind the default of 1 connection
+application = (
+    Application.builder()
+    .token(TOKEN)
+    .request(HTTPXRequest(
+        connection_pool_size=64,
+        connect_timeout=5,
+        read_timeout=20,
+        pool_timeout=5,
+    ))
+    .build()
+)
 
 MAIN_KEYBOARD = ReplyKeyboardMarkup(
     [
@@ -89,21 +159,47 @@ MAIN_KEYBOARD = ReplyKeyboardMarkup(
     resize_keyboard=True
 )
 
-# Start a background event loop for async PTB updates
-loop = asyncio.new_event_loop()
-threading.Thread(target=loop.run_forever, daemon=True).start()
+# Set once the Application is fully started; requests that race the
+# startup hook wait on this instead of hitting a half-initialized bot
+_ready = asyncio.Event()
 
+# PTB shares the ASGI server's event loop; no background loop/thread
+# bridge is needed anymore
+@app.before_serving
 async def start_bot():
     await application.initialize()
     await application.start()
-    print("BOT STARTED")
+    if WEBHOOK_BASE:
+        # Idempotent: only call setWebhook when the registered URL differs,
+        # so restarts/redeploys skip the extra state-mutating round trip.
+        # allowed_updates keeps Telegram from POSTing update types we
+        # never handle.
+        webhook_url = f"{WEBHOOK_BASE}/webhook/{TOKEN}"
+        info = await application.bot.get_webhook_info()
+        if info.url != webhook_url:
+            await application.bot.set_webhook(
+                url=webhook_url,
+                allowed_updates=["message", "callback_query"],
+            )
+    _ready.set()
+    log.info("Bot started")
+
 
-asyncio.run_coroutine_threadsafe(start_bot(), loop)
+@app.after_serving
+async def stop_bot():
+    await application.stop()
+    await application.shutdown()
+
+# Compiled once at import; re.search with a string pattern re-hashes the
+# re cache on every message and can recompile under cache pressure
+_URL_RE = re.compile(r"https?://\S+")
 
 def is_valid_link(text: str) -> bool:
     """Validate if text contains a valid URL"""
-    url_pattern = r"https?://[^\s]+"
-    return bool(re.search(url_pattern, text))
+    # Most submissions start with the scheme; skip the regex for those
+    if text.startswith(("http://", "https://")):
+        return True
+    return _URL_RE.search(text) is not None
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -115,17 +211,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    welcome_message = (
-        "🎉 Welcome to Referral4Referral Bot!\n\n"
-        "Here's how it works:\n"
-        "1️⃣ Send your referral link\n"
-        "2️⃣ You'll be placed in a queue\n"
-        "3️⃣ When it's your turn, you'll receive another user's referral link\n"
-        "4️⃣ Complete the referral and click '✅ Done'\n"
-        "5️⃣ You'll earn credit and rejoin the queue\n\n"
-        "📤 Send your referral link now to get started!"
-    )
-    await update.message.reply_text(welcome_message, reply_markup=get_welcome_buttons())
+    await update.message.reply_text(WELCOME_MESSAGE, reply_markup=WELCOME_BUTTONS)
 
 application.add_handler(CommandHandler("start", start))
 
@@ -133,11 +219,13 @@ application.add_handler(CommandHandler("start", start))
 async def done(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /done command - mark referral as completed"""
     user_id = update.effective_user.id
-    success, message = queue_manager.mark_referral_completed(user_id)
+    async with _write_lock:
+        success, message = await asyncio.to_thread(queue_manager.mark_referral_completed, user_id)
     await update.message.reply_text(message)
-    
+
     # Try to assign next referral
-    next_user_id, next_link = queue_manager.get_next_assignment()
+    async with _write_lock:
+        next_user_id, next_link = await asyncio.to_thread(queue_manager.get_next_assignment)
     if next_user_id:
         try:
             await context.bot.send_message(
@@ -145,7 +233,7 @@ async def done(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 text=f"🎯 Your turn! Please complete this referral:\n\n{next_link}"
             )
         except Exception as e:
-            print(f"Error sending referral to {next_user_id}: {e}")
+            log.warning("Error sending referral to %s: %s", next_user_id, e)
 
 application.add_handler(CommandHandler("done", done))
 
@@ -156,7 +244,7 @@ async def queue_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ This command is for admins only.")
         return
     
-    queue_list = queue_manager.get_full_queue_list()
+    queue_list = await asyncio.to_thread(queue_manager.get_full_queue_list)
     await update.message.reply_text(f"📋 Current Queue:\n\n{queue_list}")
 
 application.add_handler(CommandHandler("queue", queue_command))
@@ -168,8 +256,8 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ This command is for admins only.")
         return
     
-    stats_data = db.get_stats()
-    status_msg = queue_manager.get_queue_status()
+    stats_data = await asyncio.to_thread(db.get_stats)
+    status_msg = await asyncio.to_thread(queue_manager.get_queue_status)
     
     stats_text = (
         f"📊 Bot Statistics\n\n"
@@ -193,7 +281,8 @@ async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         target_user_id = int(context.args[0])
-        success, message = queue_manager.remove_user_from_queue(target_user_id)
+        async with _write_lock:
+            success, message = await asyncio.to_thread(queue_manager.remove_user_from_queue, target_user_id)
         await update.message.reply_text(message)
     except ValueError:
         await update.message.reply_text("Invalid user ID.")
@@ -212,22 +301,37 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     message_text = " ".join(context.args)
-    all_users = db.get_all_users()
-    
+
+    # Overlap the sends instead of awaiting them one by one; the
+    # semaphore plus a short sleep keeps us under Telegram's ~30 msg/s
+    sem = asyncio.Semaphore(25)
+
+    async def _send(user) -> bool:
+        async with sem:
+            try:
+                await context.bot.send_message(
+                    chat_id=user.user_id,
+                    text=f"📢 Announcement:\n\n{message_text}"
+                )
+                await asyncio.sleep(0.04)
+                return True
+            except Exception as e:
+                log.warning("Failed to send to %s: %s", user.user_id, e)
+                return False
+
+    # Stream users in batches instead of loading the whole table; each
+    # fetch runs in a worker thread so SQLite I/O stays off the loop
+    users_iter = db.iter_all_users()
     sent = 0
     failed = 0
-    
-    for user in all_users:
-        try:
-            await context.bot.send_message(
-                chat_id=user.user_id,
-                text=f"📢 Announcement:\n\n{message_text}"
-            )
-            sent += 1
-        except Exception as e:
-            print(f"Failed to send to {user.user_id}: {e}")
-            failed += 1
-    
+    while True:
+        batch = await asyncio.to_thread(lambda: list(islice(users_iter, 200)))
+        if not batch:
+            break
+        results = await asyncio.gather(*(_send(user) for user in batch))
+        sent += sum(results)
+        failed += len(results) - sum(results)
+
     await update.message.reply_text(f"✅ Broadcast complete!\nSent: {sent}, Failed: {failed}")
 
 application.add_handler(CommandHandler("broadcast", broadcast))
@@ -236,8 +340,8 @@ application.add_handler(CommandHandler("broadcast", broadcast))
 async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /info command - show user's info"""
     user_id = update.effective_user.id
-    info_text = queue_manager.get_user_info(user_id)
-    
+    info_text = await asyncio.to_thread(queue_manager.get_user_info, user_id)
+
     if info_text:
         await update.message.reply_text(info_text)
     else:
@@ -245,61 +349,58 @@ async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 application.add_handler(CommandHandler("info", info))
 
-# Handler for plain text (referral links)
-async def referral_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle referral link submission"""
-    user_id = update.effective_user.id
-    text = (update.message.text or "").strip()
-
-    if not text:
-        return
+# Menu helpers for the reply-keyboard buttons
+async def _menu_send_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "Send your referral link so we can add you to the queue.",
+        reply_markup=MAIN_KEYBOARD
+    )
 
-    if text == "Send Referral Link 📤":
+async def _menu_my_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    info_text = await asyncio.to_thread(queue_manager.get_user_info, update.effective_user.id)
+    if info_text:
+        await update.message.reply_text(info_text, reply_markup=MAIN_KEYBOARD)
+    else:
         await update.message.reply_text(
-            "Send your referral link so we can add you to the queue.",
-            reply_markup=MAIN_KEYBOARD
+            "🚫 You are no longer a member of our channel.\n"
+            "After joining, please send your referral link again.",
+            reply_markup=NOT_MEMBER_BUTTONS
         )
-        return
 
-    if text == "My Info ℹ️":
-        info_text = queue_manager.get_user_info(user_id)
-        if info_text:
-            await update.message.reply_text(info_text, reply_markup=MAIN_KEYBOARD)
-        else:
-            await update.message.reply_text(
-                "🚫 You are no longer a member of our channel.\n"
-                "After joining, please send your referral link again.",
-                reply_markup=get_not_member_buttons() 
-)
+async def _menu_queue_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    status_text = await asyncio.to_thread(queue_manager.get_queue_status)
+    await update.message.reply_text(status_text, reply_markup=MAIN_KEYBOARD)
 
-        return
+async def _menu_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(HELP_TEXT, reply_markup=HELP_BUTTONS)
 
-    if text == "Done Referral ✅":
-        await done(update, context)
-        return
-
-    if text == "Queue Status 📋":
-        await update.message.reply_text(queue_manager.get_queue_status(), reply_markup=MAIN_KEYBOARD)
-        return
+# One hash lookup instead of a chain of string compares per message
+MENU = {
+    "Send Referral Link 📤": _menu_send_link,
+    "My Info ℹ️": _menu_my_info,
+    "Done Referral ✅": done,
+    "Queue Status 📋": _menu_queue_status,
+    "Help ❓": _menu_help,
+}
 
-    if text == "Help ❓":
-        help_text = (
-            "Use the buttons to quickly access actions:\n"
-            "📤 Send Referral Link: submit your link and join the queue\n"
-            "ℹ️ My Info: view your status and credits\n"
-            "✅ Done Referral: confirm a completed referral\n"
-            "📋 Queue Status: check the current queue\n"
-            "❓ Help: short explanation"
-        )
-        await update.message.reply_text(help_text, reply_markup=get_help_buttons())  # regel 307
+# Handler for plain text (referral links)
+async def referral_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle referral link submission"""
+    user_id = update.effective_user.id
+    text = (update.message.text or "").strip()
 
+    if not text:
         return
 
+    if (menu_handler := MENU.get(text)) is not None:
+        return await menu_handler(update, context)
+
     link = text
 
     if not await check_membership(update, context):
-        if queue_manager.get_queue_position(user_id) is not None:
-            queue_manager.remove_user_from_queue(user_id)
+        if await asyncio.to_thread(queue_manager.get_queue_position, user_id) is not None:
+            async with _write_lock:
+                await asyncio.to_thread(queue_manager.remove_user_from_queue, user_id)
 
         await update.message.reply_text(
             "🚫 You are no longer a member of our channel.\n"
@@ -315,13 +416,15 @@ async def referral_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=MAIN_KEYBOARD
         )
         return
-    
-    success, message = queue_manager.add_user_to_queue(user_id, link)
-    await update.message.reply_text(message, reply_markup=get_queue_buttons()) 
 
-    
+    async with _write_lock:
+        success, message = await asyncio.to_thread(queue_manager.add_user_to_queue, user_id, link)
+    await update.message.reply_text(message, reply_markup=QUEUE_BUTTONS)
+
+
     if success:
-        next_user_id, next_link = queue_manager.get_next_assignment()
+        async with _write_lock:
+            next_user_id, next_link = await asyncio.to_thread(queue_manager.get_next_assignment)
         if next_user_id:
             try:
                 await context.bot.send_message(
@@ -329,60 +432,83 @@ async def referral_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     text=f"🎯 Your turn! Please complete this referral:\n\n{next_link}"
                 )
             except Exception as e:
-                print(f"Error sending referral to {next_user_id}: {e}")
+                log.warning("Error sending referral to %s: %s", next_user_id, e)
 
 application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, referral_handler))
 
+async def _cb_send_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.message.reply_text("Send your referral link now.", reply_markup=MAIN_KEYBOARD)
+
+async def _cb_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.message.reply_text(HELP_TEXT, reply_markup=HELP_BUTTONS)
+
+async def _cb_cancel_queue(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    async with _write_lock:
+        await asyncio.to_thread(queue_manager.remove_user_from_queue, query.from_user.id)
+    await query.message.reply_text("You have been removed from the queue.", reply_markup=MAIN_KEYBOARD)
+
+async def _cb_switch_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.message.reply_text("Send your new referral link.", reply_markup=MAIN_KEYBOARD)
+
+async def _cb_my_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    info_text = await asyncio.to_thread(queue_manager.get_user_info, query.from_user.id)
+    await query.message.reply_text(info_text or "❌ You're not in the queue.", reply_markup=MAIN_KEYBOARD)
+
+async def _cb_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.message.reply_text("Back to main menu.", reply_markup=MAIN_KEYBOARD)
+
+# callback_data -> handler; same dict-dispatch pattern as MENU above
+CALLBACKS = {
+    "refresh_membership": start,
+    "send_link": _cb_send_link,
+    "help": _cb_help,
+    "cancel_queue": _cb_cancel_queue,
+    "switch_link": _cb_switch_link,
+    "my_info": _cb_my_info,
+    "back": _cb_back,
+}
+
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()  # acknowledge the callback
 
-    if query.data == "refresh_membership":
-        await start(update, context)
-    elif query.data == "send_link":
-        await query.message.reply_text("Send your referral link now.", reply_markup=MAIN_KEYBOARD)
-    elif query.data == "help":
-        help_text = (
-            "Use the buttons to quickly access actions:\n"
-            "📤 Send Referral Link: submit your link and join the queue\n"
-            "ℹ️ My Info: view your status and credits\n"
-            "✅ Done Referral: confirm a completed referral\n"
-            "📋 Queue Status: check the current queue\n"
-            "❓ Help: short explanation"
-        )
-        await query.message.reply_text(help_text, reply_markup=get_help_buttons())
-    elif query.data == "cancel_queue":
-        user_id = query.from_user.id
-        queue_manager.remove_user_from_queue(user_id)
-        await query.message.reply_text("You have been removed from the queue.", reply_markup=MAIN_KEYBOARD)
-    elif query.data == "switch_link":
-        await query.message.reply_text("Send your new referral link.", reply_markup=MAIN_KEYBOARD)
-    elif query.data == "my_info":
-        user_id = query.from_user.id
-        info_text = queue_manager.get_user_info(user_id)
-        await query.message.reply_text(info_text or "❌ You're not in the queue.", reply_markup=MAIN_KEYBOARD)
-    elif query.data == "back":
-        await query.message.reply_text("Back to main menu.", reply_markup=MAIN_KEYBOARD)
+    if (cb_handler := CALLBACKS.get(query.data)) is not None:
+        await cb_handler(update, context)
 
 application.add_handler(CallbackQueryHandler(button_callback))  # regel 404
 
-@app.post(f"/webhook/{TOKEN}")
-def webhook():
-    data = request.get_json()
+async def _handle_update(raw: bytes):
+    """Decode and process one webhook payload off the request path"""
+    await _ready.wait()
+    data = _json_loads(raw)
+    # Update.de_json reflects over every update field; skip it entirely
+    # for update types we never handle (allowed_updates filters most of
+    # these at Telegram's side already, this catches the rest)
+    if not ("message" in data or "callback_query" in data):
+        return
     update = Update.de_json(data, application.bot)
+    await application.process_update(update)
 
-    # Schedule the async update in the background loop
-    asyncio.run_coroutine_threadsafe(application.process_update(update), loop)
+
+@app.post(f"/webhook/{TOKEN}")
+async def webhook():
+    # Grab the raw body and return immediately; JSON parse, Update
+    # construction and processing run as a background task so the
+    # response to Telegram goes out right away
+    raw = await request.get_data()
+    app.add_background_task(_handle_update, raw)
 
     return "OK"
 
 
 @app.get("/")
-def home():
+async def home():
     return "Bot running!"
 
 if __name__ == "__main__":
-    # Flask app direct starten met 0.0.0.0 en poort 10000 of os.getenv("PORT")
+    # Quart app direct starten met 0.0.0.0 en poort 10000 of os.getenv("PORT")
     port = int(os.environ.get("PORT", 10000))
-    print(f"Starting Flask server on port {port}")
+    log.info("Starting Quart server on port %s", port)
     app.run(host="0.0.0.0", port=port)
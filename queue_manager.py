@@ -3,9 +3,25 @@ Queue manager module for Referral4Referral Telegram Bot
 Handles FIFO queue logic, referral assignment, and verification
 """
 
+import threading
+from collections import OrderedDict
 from typing import Optional, List, Tuple
 from database import Database, User, UserStatus
 
+# Status values bound once at import; saves the double attribute lookup
+# (enum member, then .value) in the per-entry comparisons below
+_WAITING = UserStatus.WAITING.value
+_ASSIGNED = UserStatus.ASSIGNED.value
+_DONE = UserStatus.DONE.value
+
+# Built once instead of per listing row
+_STATUS_EMOJI = {
+    _WAITING: "⏳",
+    _ASSIGNED: "📤",
+    _DONE: "✅",
+}
+_STATUS_EMOJI_GET = _STATUS_EMOJI.get
+
 
 class QueueManager:
     """
@@ -21,7 +37,46 @@ class QueueManager:
             db: Database instance
         """
         self.db = db
-        pass  # nothing to load, DB handles queue
+        # Rendered snapshots of the read-heavy displays; dropped on every
+        # queue mutation, rebuilt lazily on the next read
+        self._cache_lock = threading.Lock()
+        self._status_cache: Optional[str] = None
+        self._list_cache: Optional[str] = None
+        # Bumped on every invalidation; a render started before a
+        # mutation must not be stored as current afterwards
+        self._cache_gen = 0
+        # In-memory mirror of the queue order; the DB stays the source of
+        # truth, every mutator below keeps this in step so position and
+        # membership reads skip the full queue scan. An OrderedDict makes
+        # requeue-to-the-back one move_to_end instead of an O(N) remove.
+        # Loaded lazily: commands that never touch queue order (e.g.
+        # /start, /help) skip the full queue read entirely
+        self._queue: Optional["OrderedDict[int, None]"] = None
+        # Lazily rebuilt (ids list, user_id -> 0-based position) snapshot;
+        # None means an order mutation happened since the last rebuild
+        self._pos: Optional[dict[int, int]] = None
+        self._ids: List[int] = []
+
+    def _queue_mirror(self) -> "OrderedDict[int, None]":
+        """Load the queue mirror on first use; caller holds _cache_lock"""
+        if self._queue is None:
+            self._queue = OrderedDict(
+                (uid, None) for uid, _ in self.db.queue_get_all()
+            )
+        return self._queue
+
+    def _order_snapshot(self) -> Tuple[List[int], dict[int, int]]:
+        """Return the ids list and position index; caller holds _cache_lock"""
+        if self._pos is None:
+            self._ids = list(self._queue_mirror())
+            self._pos = {uid: i for i, uid in enumerate(self._ids)}
+        return self._ids, self._pos
+
+    def _invalidate_cache(self) -> None:
+        with self._cache_lock:
+            self._cache_gen += 1
+            self._status_cache = None
+            self._list_cache = None
 
 
     def add_user_to_queue(self, user_id: int, referral_link: str) -> Tuple[bool, str]:
@@ -35,55 +90,44 @@ class QueueManager:
         Returns:
             Tuple[bool, str]: (success, message)
         """
-        # Check if user already exists
-        if self.db.user_exists(user_id):
+        # One atomic transaction: exists-checks, user insert and queue
+        # insert all commit (or fail) together
+        result = self.db.register_user(user_id, referral_link)
+        if result == "user_exists":
             return False, "You are already in the queue."
-
-        # Check if link already exists
-        if self.db.link_exists(referral_link):
+        if result == "link_exists":
             return False, "This referral link is already registered."
 
-        # Add user to database
-        if not self.db.add_user(user_id, referral_link):
-            return False, "Failed to add user. Please try again."
-
-        # Add to queue
-        self.db.queue_add(user_id, referral_link)
-
+        with self._cache_lock:
+            queue_mirror = self._queue_mirror()
+            if user_id not in queue_mirror:
+                queue_mirror[user_id] = None
+                self._pos = None
+        self._invalidate_cache()
         return True, "Your referral link has been added! You are in the queue."
 
     def get_queue_position(self, user_id: int) -> Optional[int]:
-        queue = self.db.queue_get_all()
-        queue_ids = [uid for uid, _ in queue]
-        try:
-            return queue_ids.index(user_id) + 1
-        except ValueError:
-            return None
-
+        with self._cache_lock:
+            pos = self._order_snapshot()[1].get(user_id)
+        return pos + 1 if pos is not None else None
 
-    def get_next_user_to_assign(self) -> Optional[int]:
-        queue = self.db.queue_get_all()
+    def _user_and_position(self, user_id: int) -> Tuple[Optional[User], Optional[int]]:
+        """Fetch the user row and their 1-based queue position in one path"""
+        user = self.db.get_user(user_id)
+        if user is None:
+            return None, None
+        return user, self.get_queue_position(user_id)
 
-        for user_id, link in queue:
-            user = self.db.get_user(user_id)
-            if user and user.status == UserStatus.WAITING.value:
-                return user_id
 
-        return None
+    def get_next_user_to_assign(self) -> Optional[int]:
+        # One JOIN instead of a get_user round-trip per queue entry
+        return self.db.queue_first_waiting()
 
     def get_referral_target(self, user_id: int) -> Optional[int]:
-        queue = self.db.queue_get_all()
-        queue_ids = [uid for uid, _ in queue]
-    
-        if user_id not in queue_ids:
-            return None
-
-        pos = queue_ids.index(user_id)
-
-        if pos + 1 < len(queue_ids):
-            return queue_ids[pos + 1]
-
-        return None
+        # Indexed range scan on (timestamp, user_id): the DB finds the
+        # next entry in log N without walking the queue
+        nxt = self.db.queue_next_after(user_id, 1)
+        return nxt[0] if nxt else None
 
 
     def assign_referral(self, user_id: int) -> Tuple[bool, Optional[str], Optional[int]]:
@@ -94,28 +138,13 @@ class QueueManager:
         if not user:
             return False, None, None
 
-        if user.status != UserStatus.WAITING.value:
+        if user.status != _WAITING:
             return False, None, None
 
-        # Haal volledige queue op uit de database
-        queue = self.db.queue_get_all()
-        queue_ids = [uid for uid, _ in queue]
-
-        # User moet in de queue staan
-        if user_id not in queue_ids:
-            return False, None, None
-
-        current_pos = queue_ids.index(user_id)
-
-        # Zoek de volgende veilige referral target
-        target_id = None
-        for next_pos in range(current_pos + 1, len(queue_ids)):
-            candidate_id = queue_ids[next_pos]
-            # Skip mensen die eerder met elkaar matchten
-            if not self.db.has_interacted_before(user_id, candidate_id):
-                target_id = candidate_id
-                break
-
+        # Eén query: eerstvolgende kandidaat achter ons in de queue die
+        # nog niet eerder met ons gematcht is (None als we niet in de
+        # queue staan of er geen kandidaat is)
+        target_id = self.db.queue_next_eligible(user_id)
         if not target_id:
             return False, None, None
 
@@ -126,10 +155,11 @@ class QueueManager:
         # Update user status to ASSIGNED
         self.db.update_user_status(
             user_id,
-            UserStatus.ASSIGNED.value,
+            _ASSIGNED,
             assigned_to=target_id
         )
 
+        self._invalidate_cache()
         return True, target_user.referral_link, target_id
 
 
@@ -148,28 +178,24 @@ class QueueManager:
         if not user:
             return False, "User not found."
 
-        if user.status != UserStatus.ASSIGNED.value:
+        if user.status != _ASSIGNED:
             return False, "You don't have a pending referral to complete."
 
         # Get the target user they referred
         target_id = user.assigned_to
 
-       # Mark referral as completed
-        self.db.increment_completed_referrals(user_id)
-
-        # Save referral pair to history (prevents future rematches)
-        if target_id:
-            self.db.add_referral_history(user_id, target_id)
-
-
-        # Move user back to WAITING status
-        self.db.update_user_status(user_id, UserStatus.WAITING.value, assigned_to=None)
-
-        # Move user to the back of the queue (DB-based)
-        self.db.queue_delete(user_id)
-        self.db.queue_add(user_id, user.referral_link)
-
-
+        # Counter, history, status reset and requeue-to-the-back commit
+        # (and fsync) as one transaction
+        self.db.complete_referral(user_id, target_id, user.referral_link)
+        with self._cache_lock:
+            queue_mirror = self._queue_mirror()
+            if user_id in queue_mirror:
+                queue_mirror.move_to_end(user_id)
+            else:
+                queue_mirror[user_id] = None
+            self._pos = None
+
+        self._invalidate_cache()
         return True, "Referral completed! You've been added back to the queue."
 
     def get_queue_list(self, limit: Optional[int] = None) -> List[str]:
@@ -182,43 +208,45 @@ class QueueManager:
         Returns:
             List of formatted queue entries
         """
-        queue_list = []
-        
-        queue = [uid for uid, _ in self.db.queue_get_all()]
-        for i, user_id in enumerate(queue[:limit], 1):
-
-            user = self.db.get_user(user_id)
-            if user:
-                status_emoji = {
-                    UserStatus.WAITING.value: "⏳",
-                    UserStatus.ASSIGNED.value: "📤",
-                    UserStatus.DONE.value: "✅",
-                }.get(user.status, "❓")
-
-                queue_list.append(
-                    f"{i}. User {user_id} {status_emoji} ({user.status})\n"
-                    f"   Referrals completed: {user.completed_referrals}"
-                )
-
-        return queue_list
+        # One JOIN brings back the page plus each user's status and
+        # referral count; no per-entry follow-up queries
+        return [
+            f"{i}. User {row['user_id']} {_STATUS_EMOJI_GET(row['status'], '❓')} ({row['status']})\n"
+            f"   Referrals completed: {row['completed_referrals']}"
+            for i, row in enumerate(self.db.queue_list_with_users(limit), 1)
+        ]
 
     def get_full_queue_list(self) -> str:
         """Get full queue as formatted string"""
-        queue = self.db.queue_get_all()
-        if not queue:
-            return "Queue is empty."
+        with self._cache_lock:
+            if self._list_cache is not None:
+                return self._list_cache
+            gen = self._cache_gen
 
+        # The JOIN in get_queue_list already tells us whether the queue
+        # is empty; no separate existence query needed
         queue_list = self.get_queue_list()
-        return "\n".join(queue_list)
+        text = "\n".join(queue_list) if queue_list else "Queue is empty."
+
+        with self._cache_lock:
+            # Only store if no mutation invalidated while we rendered;
+            # otherwise this snapshot is already stale
+            if self._cache_gen == gen:
+                self._list_cache = text
+        return text
 
     def remove_user_from_queue(self, user_id: int) -> Tuple[bool, str]:
-        queue_ids = [uid for uid, _ in self.db.queue_get_all()]
-        if user_id not in queue_ids:
-            return False, "User not in queue."
+        with self._cache_lock:
+            queue_mirror = self._queue_mirror()
+            if user_id not in queue_mirror:
+                return False, "User not in queue."
+            del queue_mirror[user_id]
+            self._pos = None
 
         self.db.queue_delete(user_id)  # ← correct
         self.db.remove_user(user_id)
 
+        self._invalidate_cache()
         return True, f"User {user_id} has been removed from the queue."
 
     def get_user_info(self, user_id: int) -> Optional[str]:
@@ -231,15 +259,14 @@ class QueueManager:
         Returns:
             Formatted user info string, or None if not found
         """
-        user = self.db.get_user(user_id)
+        user, position = self._user_and_position(user_id)
         if not user:
             return None
 
-        position = self.get_queue_position(user_id)
         status_text = {
-            UserStatus.WAITING.value: "Waiting for assignment",
-            UserStatus.ASSIGNED.value: f"Assigned (refer user {user.assigned_to})",
-            UserStatus.DONE.value: "Completed",
+            _WAITING: "Waiting for assignment",
+            _ASSIGNED: f"Assigned (refer user {user.assigned_to})",
+            _DONE: "Completed",
         }.get(user.status, "Unknown")
 
         return (
@@ -269,22 +296,27 @@ class QueueManager:
         return None, None
 
     def get_queue_status(self) -> str:
-        """Get readable queue status"""        
-        queue_ids = [uid for uid, _ in self.db.queue_get_all()]
-        
-        total = len(queue_ids)
-        waiting = sum(
-            1 for uid in queue_ids
-            if self.db.get_user(uid) and self.db.get_user(uid).status == UserStatus.WAITING.value
-        )
-        assigned = sum(
-            1 for uid in queue_ids
-            if self.db.get_user(uid) and self.db.get_user(uid).status == UserStatus.ASSIGNED.value
-        )
-
-        return (
+        """Get readable queue status"""
+        with self._cache_lock:
+            if self._status_cache is not None:
+                return self._status_cache
+            gen = self._cache_gen
+
+        # One GROUP BY over the queue instead of two get_user calls per entry
+        counts = self.db.count_queue_statuses()
+        total = sum(counts.values())
+        waiting = counts.get(_WAITING, 0)
+        assigned = counts.get(_ASSIGNED, 0)
+
+        text = (
             f"📈 Queue Status\n"
             f"Total users: {total}\n"
             f"Waiting: {waiting}\n"
             f"Assigned: {assigned}"
         )
+        with self._cache_lock:
+            # Only store if no mutation invalidated while we rendered;
+            # otherwise this snapshot is already stale
+            if self._cache_gen == gen:
+                self._status_cache = text
+        return text